@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from zencamp.backfill import Checkpoint, RequestBudget
+
+
+class RequestBudgetTest(unittest.TestCase):
+    def test_full_bucket_does_not_wait(self):
+        budget = RequestBudget(60)
+        start = time.time()
+        for i in range(60):
+            budget.acquire()
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_tokens_refill_at_rate(self):
+        # 600 per minute is 10 per second
+        budget = RequestBudget(600)
+        budget.acquire(600)
+        start = time.time()
+        budget.acquire(5)
+        elapsed = time.time() - start
+        self.assertTrue(0.4 < elapsed < 1.0, elapsed)
+
+    def test_refill_is_capped_at_rate(self):
+        budget = RequestBudget(60)
+        budget.updated -= 3600
+        budget.acquire()
+        self.assertTrue(budget.tokens <= 59)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'backfill.pkl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_state_survives_reload(self):
+        Checkpoint(self.filename).save(since=1, start_time=2)
+        checkpoint = Checkpoint(self.filename)
+        self.assertEqual(checkpoint.get('start_time'), 2)
+        self.assertEqual(os.listdir(self.directory), ['backfill.pkl'])
+
+    def test_missing_file_is_empty(self):
+        self.assertEqual(Checkpoint(self.filename).get('start_time', 5), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
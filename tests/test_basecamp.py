@@ -0,0 +1,82 @@
+import unittest
+
+from zencamp.basecamp import Basecamp
+
+
+class FakeBasecamp(Basecamp):
+    """
+    Basecamp with the todo list API calls answered from memory. lists is
+    what the server holds; racing_lists are created by "another worker"
+    as soon as we create ours.
+    """
+    def __init__(self, lists=(), racing_lists=(), next_id=100):
+        Basecamp.__init__(self, 1)
+        self.lists = list(lists)
+        self.racing_lists = list(racing_lists)
+        self.next_id = next_id
+        self.calls = []
+
+    def list_todo_lists(self, project_id):
+        self.calls.append('list')
+        return [dict(l) for l in self.lists]
+
+    def create_todo_list(self, project_id, data):
+        self.calls.append('create')
+        todo_list = {'id': self.next_id, 'name': data['name']}
+        self.next_id += 1
+        self.lists.append(todo_list)
+        self.lists.extend(self.racing_lists)
+        return todo_list
+
+    def delete_todo_list(self, project_id, todo_list_id):
+        self.calls.append(('delete', todo_list_id))
+        self.lists = [l for l in self.lists if l['id'] != todo_list_id]
+
+
+class ResolveTodoListTest(unittest.TestCase):
+    def test_existing_list_is_found_without_creating(self):
+        bc = FakeBasecamp(lists=[{'id': 5, 'name': 'Today'}])
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 5)
+        self.assertEqual(bc.calls, ['list'])
+
+    def test_index_is_reused_between_lookups(self):
+        bc = FakeBasecamp(lists=[{'id': 5, 'name': 'Today'}])
+        bc.resolve_todo_list(1, 'Today')
+        bc.resolve_todo_list(1, 'Today')
+        self.assertEqual(bc.calls, ['list'])
+
+    def test_missing_list_is_created(self):
+        bc = FakeBasecamp()
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 100)
+        self.assertEqual(bc.calls, ['list', 'create', 'list'])
+        # Now indexed
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 100)
+        self.assertEqual(len(bc.calls), 3)
+
+    def test_duplicates_resolve_to_lowest_id(self):
+        bc = FakeBasecamp(lists=[{'id': 9, 'name': 'Today'},
+                                 {'id': 3, 'name': 'Today'}])
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 3)
+
+    def test_our_duplicate_is_deleted_when_another_worker_won(self):
+        bc = FakeBasecamp(racing_lists=[{'id': 50, 'name': 'Today'}])
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 50)
+        self.assertEqual(bc.calls, ['list', 'create', 'list',
+                                    ('delete', 100)])
+        self.assertEqual([l['id'] for l in bc.lists], [50])
+
+    def test_our_list_is_kept_when_it_has_the_lowest_id(self):
+        bc = FakeBasecamp(racing_lists=[{'id': 150, 'name': 'Today'}])
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 100)
+        self.assertTrue(('delete', 100) not in bc.calls)
+
+    def test_list_not_visible_yet_is_not_deleted(self):
+        bc = FakeBasecamp()
+        # The re-list doesn't include the list we just created
+        bc.list_todo_lists = lambda project_id: []
+        self.assertEqual(bc.resolve_todo_list(1, 'Today'), 100)
+        self.assertEqual(bc.calls, ['create'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import json
+import unittest
+
+import httplib2
+
+from zencamp.basecamp import Basecamp
+from zencamp.cache import ResponseCache
+from zencamp.zendesk import Zendesk
+
+
+class FakeResponse(dict):
+    def __init__(self, status, fromcache):
+        dict.__init__(self, status=status)
+        self.fromcache = fromcache
+
+
+def revalidated_response():
+    """
+    A 304 as httplib2 hands it back: the cached headers merged with the
+    304's, the status attribute set to 200 and the 'status' header left
+    at '304'
+    """
+    response = httplib2.Response({'status': '304', 'etag': '"abc"'})
+    response.status = 200
+    response.fromcache = True
+    return response
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_returns_what_was_set(self):
+        cache = ResponseCache(self.directory)
+        cache.set('http://a/1', 'one')
+        self.assertEqual(cache.get('http://a/1'), 'one')
+        self.assertEqual(cache.get('http://a/2'), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(self.directory, max_size=25)
+        cache.set('http://a/1', 'x' * 10)
+        cache.set('http://a/2', 'x' * 10)
+        # Touch 1 so 2 becomes the least recently used
+        cache.get('http://a/1')
+        cache.set('http://a/3', 'x' * 10)
+
+        self.assertEqual(cache.get('http://a/2'), None)
+        self.assertNotEqual(cache.get('http://a/1'), None)
+        self.assertNotEqual(cache.get('http://a/3'), None)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_overwrite_updates_size(self):
+        cache = ResponseCache(self.directory)
+        cache.set('http://a/1', 'x' * 10)
+        cache.set('http://a/1', 'x' * 4)
+        self.assertEqual(cache.size, 4)
+
+    def test_partial_writes_are_ignored_on_reload(self):
+        cache = ResponseCache(self.directory)
+        cache.set('http://a/1', 'one')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        open(os.path.join(self.directory, 'x.1.2.tmp'), 'wb').write('xx')
+        cache = ResponseCache(self.directory)
+        self.assertEqual(cache.size, 3)
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_delete(self):
+        cache = ResponseCache(self.directory)
+        cache.set('http://a/1', 'one')
+        cache.delete('http://a/1')
+        self.assertEqual(cache.get('http://a/1'), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_entries_survive_reload(self):
+        ResponseCache(self.directory).set('http://a/1', 'one')
+        cache = ResponseCache(self.directory)
+        self.assertEqual(cache.get('http://a/1'), 'one')
+        self.assertEqual(cache.size, 3)
+
+    def test_stats_separate_fresh_hits_and_revalidations(self):
+        cache = ResponseCache(self.directory)
+        cache.record(FakeResponse('200', False))
+        cache.record(FakeResponse('200', True))
+        cache.record(FakeResponse('304', True))
+        cache.record(FakeResponse('304', True))
+
+        stats = cache.stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['revalidated'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.75)
+
+
+    def test_merged_304_is_accepted_and_counted_as_revalidated(self):
+        cache = ResponseCache(self.directory)
+        content = json.dumps({'group': {'id': 3}})
+        for client in (Zendesk, Basecamp):
+            response = revalidated_response()
+            self.assertEqual(
+                client._response_handler(response, content, 200),
+                {'group': {'id': 3}})
+            cache.record(response)
+
+        stats = cache.stats()
+        self.assertEqual(stats['revalidated'], 2)
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['misses'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
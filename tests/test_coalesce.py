@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+
+from zencamp.coalesce import MicroBatcher, SingleFlight
+
+
+def run_threads(target, args_list):
+    threads = [threading.Thread(target=target, args=args)
+               for args in args_list]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.05)
+            return {'id': 1}
+
+        run_threads(lambda: results.append(flight.do('key', fetch)),
+                    [()] * 10)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_error_is_raised_in_every_waiter(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fetch():
+            time.sleep(0.05)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                flight.do('key', fetch)
+            except ValueError as e:
+                errors.append(e)
+
+        run_threads(call, [()] * 5)
+        self.assertEqual(len(errors), 5)
+
+    def test_sequential_calls_are_not_cached(self):
+        flight = SingleFlight()
+        calls = []
+        flight.do('key', lambda: calls.append(1))
+        flight.do('key', lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def test_batches_split_at_max_size(self):
+        batches = []
+
+        def fetch_many(ids):
+            batches.append(list(ids))
+            return dict((i, i * 10) for i in ids)
+
+        batcher = MicroBatcher(fetch_many, window=0.05, max_size=4)
+        results = {}
+        run_threads(lambda i: results.__setitem__(i, batcher.get(i)),
+                    [(i, ) for i in range(10)])
+
+        self.assertEqual(results, dict((i, i * 10) for i in range(10)))
+        self.assertTrue(all(len(b) <= 4 for b in batches))
+        self.assertEqual(sorted(sum(batches, [])), range(10))
+
+    def test_full_batch_is_sent_before_window(self):
+        batcher = MicroBatcher(lambda ids: {}, window=5, max_size=2)
+        start = time.time()
+        run_threads(batcher.get, [(1, ), (2, )])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_missing_ids_resolve_to_none(self):
+        batcher = MicroBatcher(lambda ids: {}, window=0)
+        self.assertEqual(batcher.get(1), None)
+
+    def test_error_is_raised_in_every_waiter(self):
+        def fetch_many(ids):
+            raise ValueError("boom")
+
+        batcher = MicroBatcher(fetch_many, window=0.05)
+        errors = []
+
+        def get(i):
+            try:
+                batcher.get(i)
+            except ValueError as e:
+                errors.append(e)
+
+        run_threads(get, [(i, ) for i in range(3)])
+        self.assertEqual(len(errors), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
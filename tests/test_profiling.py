@@ -0,0 +1,37 @@
+import threading
+import unittest
+
+from zencamp.profiling import StageTimer
+
+
+class StageTimerTest(unittest.TestCase):
+    def test_repeated_stages_are_summed(self):
+        timer = StageTimer()
+        for i in range(3):
+            with timer.stage('fetch'):
+                pass
+        with timer.stage('write'):
+            pass
+
+        self.assertEqual(timer.stages.keys(), ['fetch', 'write'])
+        self.assertEqual(timer.stages['fetch'][2], 3)
+
+    def test_stages_from_threads_are_all_counted(self):
+        timer = StageTimer()
+
+        def work():
+            for i in range(1000):
+                with timer.stage('write'):
+                    pass
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(timer.stages['write'][2], 4000)
+
+
+if __name__ == '__main__':
+    unittest.main()
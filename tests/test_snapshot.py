@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zencamp.snapshot import TicketSnapshot, UNKNOWN
+
+
+def ticket(id, status='open', group_id=1, created_at='2012-01-01T00:00:00Z',
+           **kwargs):
+    return dict(id=id, status=status, group_id=group_id,
+                created_at=created_at, **kwargs)
+
+
+class TicketSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tickets.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load_round_trip(self):
+        snapshot = TicketSnapshot(self.filename)
+        snapshot.update([ticket(1, priority='high'), ticket(2, 'solved')])
+        snapshot.cursor = 1234
+        snapshot.save()
+
+        loaded = TicketSnapshot(self.filename)
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(loaded.cursor, 1234)
+        self.assertEqual(list(loaded.ids), list(snapshot.ids))
+        self.assertEqual(list(loaded.status), list(snapshot.status))
+        self.assertEqual(list(loaded.priority), list(snapshot.priority))
+        self.assertEqual(list(loaded.created_at), [1325376000] * 2)
+        self.assertEqual(os.listdir(self.directory), ['tickets.snapshot'])
+
+    def test_update_existing_row_in_place(self):
+        snapshot = TicketSnapshot()
+        snapshot.update([ticket(1), ticket(2)])
+        snapshot.update([ticket(1, 'solved', group_id=5)])
+
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.count_by_group(), {1: 1})
+        self.assertEqual(snapshot.count_by_group(('solved', )), {5: 1})
+
+    def test_truncated_file_loads_empty(self):
+        snapshot = TicketSnapshot(self.filename)
+        snapshot.update([ticket(i) for i in range(10)])
+        snapshot.save()
+        data = open(self.filename, 'rb').read()
+
+        # Short column data (EOFError) and a short header (struct.error)
+        for size in (len(data) - 8, 3):
+            open(self.filename, 'wb').write(data[:size])
+            self.assertEqual(len(TicketSnapshot(self.filename)), 0)
+
+    def test_empty_file_loads_empty(self):
+        open(self.filename, 'wb').close()
+        snapshot = TicketSnapshot(self.filename)
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(snapshot.cursor, 0)
+
+    def test_unknown_and_missing_values_use_sentinel(self):
+        snapshot = TicketSnapshot()
+        snapshot.update([ticket(1, 'deleted', priority='extreme'),
+                         ticket(2, None)])
+
+        self.assertEqual(list(snapshot.status), [UNKNOWN, UNKNOWN])
+        self.assertEqual(snapshot.priority[0], UNKNOWN)
+        self.assertEqual(snapshot.count_by_group(), {})
+        self.assertEqual(snapshot.count_by_group(('deleted', )), {})
+
+    def test_tickets_without_group_count_under_none(self):
+        snapshot = TicketSnapshot()
+        snapshot.update([ticket(1, group_id=None), ticket(2)])
+        self.assertEqual(snapshot.count_by_group(), {None: 1, 1: 1})
+
+    def test_age_histogram_bucket_edges(self):
+        now = 1325376000 + 100
+        snapshot = TicketSnapshot()
+        # Ages of 100, 50 and 10 seconds
+        snapshot.update([
+            ticket(1),
+            ticket(2, created_at='2012-01-01T00:00:50Z'),
+            ticket(3, created_at='2012-01-01T00:01:30Z'),
+        ])
+
+        # Bounds are inclusive upper limits, the last bucket is overflow
+        self.assertEqual(snapshot.age_histogram([10, 50], now=now),
+                         [1, 1, 1])
+        self.assertEqual(snapshot.age_histogram([9, 100], now=now),
+                         [0, 3, 0])
+        self.assertEqual(snapshot.sla_breaches(50, now=now), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+import unittest
+
+import httplib2
+
+from zencamp import zendesk
+from zencamp.zendesk import Zendesk, ZendeskException
+
+
+class FakeHttp(object):
+    """
+    Stands in for httplib2.Http, answering every request with routes[url]
+    """
+    cache = None
+
+    def __init__(self, routes, delay=0):
+        self.routes = routes
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, url, method, body=None, headers=None):
+        with self.lock:
+            self.requests.append((method, url))
+        time.sleep(self.delay)
+        status, payload = self.routes[url]
+        return httplib2.Response({'status': str(status)}), json.dumps(payload)
+
+
+class FakeZendesk(Zendesk):
+    # One fake client shared by all threads instead of one Http per thread
+    client = None
+
+
+def make_zendesk(routes, delay=0, **kwargs):
+    zd = FakeZendesk('example.zendesk.com', **kwargs)
+    zd.client = FakeHttp(routes, delay)
+    return zd
+
+
+URI = 'https://example.zendesk.com'
+
+
+class ZendeskRequestTest(unittest.TestCase):
+    def test_show_user_uses_v2_path(self):
+        zd = make_zendesk({
+            URI + '/api/v2/users/5.json?': (200, {'user': {'id': 5}})})
+        self.assertEqual(zd.show_user(user_id=5), {'user': {'id': 5}})
+
+    def test_show_organization_uses_v2_path(self):
+        zd = make_zendesk({
+            URI + '/api/v2/organizations/7.json?':
+                (200, {'organization': {'id': 7}})})
+        self.assertEqual(zd.show_organization(organization_id=7),
+                         {'organization': {'id': 7}})
+
+    def test_concurrent_gets_share_one_request(self):
+        zd = make_zendesk({URI + '/groups/3.json?': (200, {'group': {}})},
+                          delay=0.05)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(zd.show_group(group_id=3)))
+            for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(zd.client.requests), 1)
+        self.assertEqual(len(results), 5)
+
+    def test_writes_are_not_coalesced(self):
+        zd = make_zendesk({URI + '/groups/3.json?': (200, {})})
+        zd.update_group(group_id=3, data={'group': {}})
+        zd.update_group(group_id=3, data={'group': {}})
+        self.assertEqual(len(zd.client.requests), 2)
+
+    def test_unexpected_status_raises(self):
+        zd = make_zendesk({URI + '/groups/3.json?': (500, {})})
+        self.assertRaises(ZendeskException, zd.show_group, group_id=3)
+
+
+class SequenceHttp(FakeHttp):
+    """
+    Answers with the next (status, headers, payload) from responses
+    """
+    def __init__(self, responses):
+        FakeHttp.__init__(self, {})
+        self.responses = list(responses)
+
+    def request(self, url, method, body=None, headers=None):
+        self.requests.append((method, url))
+        status, response_headers, payload = self.responses.pop(0)
+        response = httplib2.Response(dict(response_headers,
+                                          status=str(status)))
+        return response, json.dumps(payload)
+
+
+class ZendeskRateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self._sleep = zendesk.time.sleep
+        zendesk.time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        zendesk.time.sleep = self._sleep
+
+    def test_429_is_retried_after_retry_after(self):
+        zd = FakeZendesk('example.zendesk.com')
+        zd.client = SequenceHttp([
+            (429, {'retry-after': '7'}, {}),
+            (200, {}, {'tickets': [], 'count': 0, 'end_time': 1}),
+        ])
+        result = zd.incremental_tickets(start_time=0)
+
+        self.assertEqual(result['end_time'], 1)
+        self.assertEqual(self.sleeps, [7])
+        self.assertEqual(len(zd.client.requests), 2)
+
+    def test_gives_up_after_retries(self):
+        zd = FakeZendesk('example.zendesk.com')
+        zd.client = SequenceHttp(
+            [(429, {'retry-after': '1'}, {})] *
+            (zendesk.RATE_LIMIT_RETRIES + 1))
+        try:
+            zd.incremental_tickets(start_time=0)
+        except ZendeskException as e:
+            self.assertEqual(e.error_code, 429)
+        else:
+            self.fail("ZendeskException not raised")
+        self.assertEqual(len(self.sleeps), zendesk.RATE_LIMIT_RETRIES)
+
+
+class ZendeskBatchTest(unittest.TestCase):
+    def test_batched_lookups_return_single_payload(self):
+        zd = make_zendesk({
+            URI + '/api/v2/users/show_many.json?ids=1%2C2':
+                (200, {'users': [{'id': 1}, {'id': 2}]}),
+        }, batch_window=0.05)
+        results = {}
+        threads = [threading.Thread(
+            target=lambda i=i: results.__setitem__(
+                i, zd.show_user(user_id=i)))
+            for i in (1, 2)]
+        for t in threads:
+            t.start()
+            # Keep the order of ids in the bulk call stable
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, {1: {'user': {'id': 1}},
+                                   2: {'user': {'id': 2}}})
+        self.assertEqual(len(zd.client.requests), 1)
+
+    def test_batched_missing_id_raises_not_found(self):
+        zd = make_zendesk({
+            URI + '/api/v2/users/show_many.json?ids=9': (200, {'users': []}),
+        }, batch_window=0.01)
+        try:
+            zd.show_user(user_id=9)
+        except ZendeskException as e:
+            self.assertEqual(e.error_code, 404)
+        else:
+            self.fail("ZendeskException not raised")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,130 +1,110 @@
 from zencamp.common import Config
 from zencamp.zendesk import Zendesk
 from zencamp.basecamp import Basecamp
+from zencamp.snapshot import TicketSnapshot, parse_timestamp
+from zencamp.profiling import Profiler, StageTimer
+from zencamp.backfill import Checkpoint, RequestBudget
+from zencamp.cache import ResponseCache
 
+from calendar import timegm
 from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from os import path
 
+import argparse
+import atexit
+import fcntl
 import logging
 import pickle
+import re
 import sys
+import threading
 
 
 # Helpers
 class ProcessLog(object):
+    """
+    Ids of tickets already pushed to Basecamp.
+
+    New ids are appended to processed.log one line at a time, so a sync
+    and a backfill running side by side never overwrite each other's
+    entries. processed.pkl from earlier versions is still read.
+    """
     def __init__(self):
-        if not path.exists("processed.pkl"):
-            self.processed = []
-        else:
+        self.legacy = set()
+        if path.exists("processed.pkl"):
             f = open('processed.pkl', 'rb')
-            self.processed = pickle.load(f)
+            self.legacy = set(p['id'] for p in pickle.load(f))
             f.close()
+        # Backfill workers record tickets concurrently
+        self.lock = threading.Lock()
 
     def get_processed(self):
-        return [p['id'] for p in self.processed]
+        processed = set(self.legacy)
+        if path.exists("processed.log"):
+            f = open('processed.log', 'r')
+            for line in f:
+                # Skip a partial last line left by a crash mid-write
+                if line.endswith('\n'):
+                    processed.add(int(line.split('\t')[0]))
+            f.close()
+        return processed
 
     def add_processed(self, id):
-        self.processed.append({'id': id, 'date': datetime.now()})
-        f = open('processed.pkl', 'wb')
-        pickle.dump(self.processed, f, True)
-        f.close()
+        with self.lock:
+            f = open('processed.log', 'a')
+            f.write("%d\t%s\n" % (id, datetime.now().isoformat()))
+            f.close()
 
 
-# Configure logging
-FORMAT = "%(asctime)-15s - %(levelname)8s - %(module)s - %(message)s"
-logging.basicConfig(format=FORMAT, level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+def client_args(config):
+    """
+    Build the http client arguments for both APIs, adding a shared
+    response cache when a [cache] section is configured.
+    """
+    cc = config.cache()
+    if cc is None:
+        return {}
+
+    cache = ResponseCache(cc.directory, int(cc.max_size))
 
-logger.info("Starting Zendesk <-> Basecamp sync")
-
-# Get configuration
-config = Config()
-logger.debug("Getting Zendesk configuration...")
-zc = config.zendesk()
-logger.debug("Zendesk configuration: " + ", ".join("%s(%s)" % (
-    a, getattr(zc, a)) for a in dir(zc) if not a.startswith("_")))
-bc = config.basecamp()
-logger.debug("Basecamp configuration: " + ", ".join("%s(%s)" % (
-    a, getattr(bc, a)) for a in dir(bc) if not a.startswith("_")))
-process_log = ProcessLog()
-
-# Stage 1 - Zendesk -> Basecamp
-# Grab all recent tickets from zendesk
-zdi = Zendesk(zc.subdomain, zc.username, zc.password)
-logger.info("Connecting to Zendesk and requesting recent ticket list.")
-recent_tickets = zdi.recent_tickets()
-all_groups = zdi.list_groups()
-GROUPS = {'Feeds': None, 'L3 Support': None}
-for g in all_groups:
-    if g['name'] in GROUPS:
-        GROUPS[g['name']] = g['id']
-
-# This contains the list of tickets we are interested in sending to Basecamp
-queue = []
-
-# This comes from a pickle file containing our /already processed/ list
-ALREADY_PROCESSED = process_log.get_processed()
-
-for rt in recent_tickets['tickets']:
-    if rt['status'] in ('new', 'open'):
-        logger.debug("Ticket #%d - %s" % (rt['id'], rt['subject']))
-        for grp, gid in GROUPS.items():
-            if rt['group_id'] == gid:
-                # At this point we have new | open tickets in our groups
-                if rt['id'] not in ALREADY_PROCESSED:
-                    logger.info("Adding ticket #%d to queue" % rt['id'])
-                    queue.append(rt)
-
-logger.info("%d tickets to process." % len(queue))
-
-# Bail out if there is nothing to process
-if len(queue) < 1:
-    logger.info("Nothing to process, exiting.")
-    sys.exit(0)
-
-# Login to Basecamp and find Backlog project
-bci = Basecamp(bc.basecamp_id, bc.username, bc.password)
-logger.info("Connecting to Basecamp and requesting project list.")
-bc_projects = bci.list_projects()
-bc_project = None
-for bp in  bc_projects:
-    if bp['name'] == bc.project:
-        bc_project = bp
-
-if bc_project:
-    logger.info("Found project '%(name)s' (id: %(id)d)" % (bc_project))
-else:
-    logger.fatal("Couldn't find project named '%s'" % bc.project)
+    def report():
+        stats = cache.stats()
+        stats['hit_rate'] *= 100
+        logger.info("Response cache: %(requests)d GETs, %(hits)d fresh hits, "
+                    "%(revalidated)d 304 revalidations, %(misses)d misses "
+                    "(hit rate %(hit_rate).1f%%), %(entries)d entries, "
+                    "%(size)d bytes, %(evictions)d evictions" % stats)
+    atexit.register(report)
+    return {'cache': cache}
+
+
+def find_project(bci, name):
+    """
+    Return the Basecamp project called name, exiting if there isn't one.
+    """
+    logger.info("Connecting to Basecamp and requesting project list.")
+    for bp in bci.list_projects():
+        if bp['name'] == name:
+            logger.info("Found project '%(name)s' (id: %(id)d)" % (bp))
+            return bp
+
+    logger.fatal("Couldn't find project named '%s'" % name)
     sys.exit(1)
 
-todo_list = None
-todo_list_name = date.today().strftime(bc.todo_list)
-
-logger.info("Searching for todo list %s..." % todo_list_name)
-# Check for Todo List
-for bc_todo_list in bci.list_todo_lists(project_id=bc_project['id']):
-    if bc_todo_list['name'] == todo_list_name:
-        todo_list = bc_todo_list
-        logger.info("Found matching todo list, appending todo...")
-
-# Create Todo List if it doesn't exist
-if not todo_list:
-    logger.info("Couldn't find matching todo list, creating it...")
-    todo_list_uri = bci.create_todo_list(project_id=bc_project['id'], data={
-        'name': todo_list_name,
-        'description': "Zendesk Syndication Support"})
-    tdid = todo_list_uri.split('/todolists/')[1].split('-')[0]
-    todo_list = bci.get_todo_list(project_id=bc_project['id'],
-            todo_list_id=tdid)
-
-for bc_ticket in queue:
-    logger.info("Processing Zendesk ticket #%s..." % bc_ticket['id'])
+
+def push_ticket(bci, bc, project_id, todo_list_id, ticket):
+    """
+    Create a Basecamp todo for a Zendesk ticket, with the ticket request
+    as its first comment.
+    """
+    logger.info("Processing Zendesk ticket #%s..." % ticket['id'])
 
     # Add todo to todo_list
     two_days = str(date.today() + timedelta(days=2))
     todo_data = {
-        'content': '#%s - %s (Priority: %s) [?]' % (bc_ticket['id'],
-            bc_ticket['subject'], bc_ticket['priority']),
+        'content': '#%s - %s (Priority: %s) [?]' % (ticket['id'],
+            ticket['subject'], ticket['priority']),
         'due_at': two_days,
         'assignee': {
             'id': bc.auto_assign_to,
@@ -132,23 +112,310 @@ for bc_ticket in queue:
         }
     }
     logger.info("Creating todo in Basecamp...")
-    todo_uri = bci.create_todo(project_id=bc_project['id'],
-            todo_list_id=todo_list['id'], data=todo_data)
+    todo = bci.create_todo(project_id=project_id,
+            todo_list_id=todo_list_id, data=todo_data)
 
     # Add comment containing ticket request info
-    todo_id = todo_uri.split('/todos/')[1].split('-')[0]
     todo_comment_data = {
-        "content": bc_ticket['description'],
+        "content": ticket['description'],
         "subscribers": [bc.auto_assign_to]
     }
     logger.info("Adding ticket request as comment...")
-    comment_uri = bci.create_todo_comment(project_id=bc_project['id'],
-            todo_id=todo_id, data=todo_comment_data)
+    bci.create_todo_comment(project_id=project_id,
+            todo_id=todo['id'], data=todo_comment_data)
+
+
+TODO_LIST_DESCRIPTION = "Zendesk Syndication Support"
+SNAPSHOT_FILE = "tickets.snapshot"
+# Zendesk allows 10 incremental export requests per minute
+EXPORT_RATE = 10
+# Incremental export pages (up to 1000 tickets each) fetched per sync run
+SNAPSHOT_PAGES = 5
+
+
+def refresh_snapshot(zdi, max_pages=SNAPSHOT_PAGES):
+    """
+    Bring the local ticket snapshot up to date from Zendesk's incremental
+    ticket export.
+
+    recent_tickets only lists tickets the API user viewed recently, so
+    tickets solved in the web UI would never be refreshed. The export
+    returns every ticket changed since the cursor stored in the snapshot
+    instead. A new snapshot starts from the beginning and catches up over
+    several runs, max_pages at a time. Runs that overlap skip the refresh
+    rather than overwrite each other's updates.
+    """
+    lock = open(SNAPSHOT_FILE + '.lock', 'a')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            logger.info("Ticket snapshot is being refreshed by another "
+                        "process, skipping.")
+            return
+
+        snapshot = TicketSnapshot(SNAPSHOT_FILE)
+        for page in range(max_pages):
+            result = zdi.incremental_tickets(start_time=snapshot.cursor)
+            logger.debug("Updated %d tickets in local snapshot." %
+                         snapshot.update(result['tickets']))
+            caught_up = (result['count'] < 1000 or
+                         result['end_time'] == snapshot.cursor)
+            snapshot.cursor = result['end_time']
+            if caught_up:
+                break
+        snapshot.save()
+    finally:
+        lock.close()
+
+
+def sync(args):
+    with timer.stage('config'):
+        # Get configuration
+        config = Config()
+        logger.debug("Getting Zendesk configuration...")
+        zc = config.zendesk()
+        logger.debug("Zendesk configuration: " + ", ".join("%s(%s)" % (
+            a, getattr(zc, a)) for a in dir(zc) if not a.startswith("_")))
+        bc = config.basecamp()
+        logger.debug("Basecamp configuration: " + ", ".join("%s(%s)" % (
+            a, getattr(bc, a)) for a in dir(bc) if not a.startswith("_")))
+        process_log = ProcessLog()
+        http_args = client_args(config)
+
+    # Stage 1 - Zendesk -> Basecamp
+    # Grab all recent tickets from zendesk
+    with timer.stage('fetch'):
+        zdi = Zendesk(zc.subdomain, zc.username, zc.password,
+            client_args=http_args)
+        logger.info("Connecting to Zendesk and requesting recent ticket "
+                    "list.")
+        recent_tickets = zdi.recent_tickets()
+
+        all_groups = zdi.list_groups()
+        GROUPS = {'Feeds': None, 'L3 Support': None}
+        for g in all_groups:
+            if g['name'] in GROUPS:
+                GROUPS[g['name']] = g['id']
+
+    with timer.stage('snapshot'):
+        # Keep the local ticket snapshot (used for backlog stats) up to date
+        refresh_snapshot(zdi)
+
+    with timer.stage('filter'):
+        # This contains the list of tickets we are interested in sending
+        # to Basecamp
+        queue = []
+
+        # This comes from a pickle file containing our /already processed/
+        # list
+        ALREADY_PROCESSED = process_log.get_processed()
+
+        for rt in recent_tickets['tickets']:
+            if rt['status'] in ('new', 'open'):
+                logger.debug("Ticket #%d - %s" % (rt['id'], rt['subject']))
+                for grp, gid in GROUPS.items():
+                    if rt['group_id'] == gid:
+                        # At this point we have new | open tickets in our
+                        # groups
+                        if rt['id'] not in ALREADY_PROCESSED:
+                            logger.info("Adding ticket #%d to queue" %
+                                        rt['id'])
+                            queue.append(rt)
+
+        logger.info("%d tickets to process." % len(queue))
+
+    with timer.stage('resolve'):
+        # Login to Basecamp and find Backlog project
+        bci = Basecamp(bc.basecamp_id, bc.username, bc.password,
+            client_args=http_args)
+        bc_project = find_project(bci, bc.project)
+
+        if queue:
+            todo_list_name = date.today().strftime(bc.todo_list)
+
+            logger.info("Resolving todo list %s..." % todo_list_name)
+            todo_list_id = bci.resolve_todo_list(bc_project['id'],
+                    todo_list_name, TODO_LIST_DESCRIPTION)
+
+        # Create tomorrow's todo list ahead of time so the first run of the
+        # day doesn't have to. This runs even when the queue is empty.
+        tomorrow_list_name = (date.today() + timedelta(days=1)).strftime(
+                bc.todo_list)
+        logger.info("Pre-creating todo list %s..." % tomorrow_list_name)
+        bci.resolve_todo_list(bc_project['id'], tomorrow_list_name,
+                TODO_LIST_DESCRIPTION)
+
+    # Bail out if there is nothing to process
+    if len(queue) < 1:
+        logger.info("Nothing to process, exiting.")
+        sys.exit(0)
+
+    with timer.stage('write'):
+        for bc_ticket in queue:
+            push_ticket(bci, bc, bc_project['id'], todo_list_id, bc_ticket)
+
+            # Add ticket id to processed history
+            process_log.add_processed(bc_ticket['id'])
+
+    # Stage 2 - Basecamp -> Zendesk
+    # Loop through Basecamp todos in Backlog and Current Sprint, find todos
+    # we submitted. If they're closed, take last comment and append it to
+    # zendesk ticket, notify assignee of update.
+
+
+def backfill(args):
+    """
+    Push older tickets of one group into Basecamp.
+
+    Pages through Zendesk's incremental ticket export from --since, pushing
+    each page's matching tickets with a pool of workers. The export cursor
+    is checkpointed after every page, and tickets already in the processed
+    log are skipped, so an interrupted backfill can simply be re-run.
+
+    The ticket snapshot is left to sync, whose own export cursor covers
+    the same tickets; writing it here would race with a concurrent sync.
+    """
+    with timer.stage('config'):
+        config = Config()
+        zc = config.zendesk()
+        bc = config.basecamp()
+        process_log = ProcessLog()
+        http_args = client_args(config)
+        budget = RequestBudget(args.budget)
+        # The export has its own, lower rate limit
+        export_budget = RequestBudget(min(EXPORT_RATE, args.budget))
+
+    with timer.stage('resolve'):
+        # Every API request, including todo list creation and reconciliation,
+        # is charged to the budget by the clients
+        zdi = Zendesk(zc.subdomain, zc.username, zc.password,
+                client_args=http_args, request_budget=budget)
+        group_id = None
+        for g in zdi.list_groups():
+            if g['name'] == args.group:
+                group_id = g['id']
+        if group_id is None:
+            logger.fatal("Couldn't find group named '%s'" % args.group)
+            sys.exit(1)
+
+        bci = Basecamp(bc.basecamp_id, bc.username, bc.password,
+                client_args=http_args, request_budget=budget)
+        project_id = find_project(bci, bc.project)['id']
+        todo_list_id = bci.resolve_todo_list(project_id,
+                date.today().strftime(bc.todo_list), TODO_LIST_DESCRIPTION)
+
+    # Workers share bci, which keeps an http client per thread
+    def push(ticket):
+        push_ticket(bci, bc, project_id, todo_list_id, ticket)
+        process_log.add_processed(ticket['id'])
+
+    since = timegm(args.since.timetuple())
+    checkpoint = Checkpoint(args.checkpoint or "backfill-%s.pkl" %
+            re.sub(r'\W+', '_', args.group).lower())
+    if checkpoint.get('since') != since:
+        checkpoint.state = {}
+    start_time = checkpoint.get('start_time', since)
+    statuses = args.status.split(',')
+
+    pool = ThreadPool(args.workers)
+    try:
+        while True:
+            logger.info("Requesting tickets updated since %s..." %
+                        datetime.utcfromtimestamp(start_time))
+            with timer.stage('fetch'):
+                export_budget.acquire()
+                result = zdi.incremental_tickets(start_time=start_time)
+
+            with timer.stage('filter'):
+                processed = process_log.get_processed()
+                page = [t for t in result['tickets']
+                        if t['group_id'] == group_id and
+                        t['status'] in statuses and
+                        parse_timestamp(t['created_at']) >= since and
+                        t['id'] not in processed]
+                logger.info("%d of %d tickets to process." % (
+                    len(page), len(result['tickets'])))
+
+            with timer.stage('write'):
+                pool.map(push, page)
+
+            checkpoint.save(since=since, start_time=result['end_time'])
+            # The export returns full pages of 1000 until it is caught up
+            if (result['count'] < 1000 or
+                    result['end_time'] == start_time):
+                break
+            start_time = result['end_time']
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info("Backfill of group '%s' complete." % args.group)
+
+
+def since_date(value):
+    """
+    argparse type for --since, so bad dates are reported as usage errors
+    """
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid date '%s', expected YYYY-MM-DD" % value)
+
+
+# Configure logging
+FORMAT = "%(asctime)-15s - %(levelname)8s - %(module)s - %(message)s"
+logging.basicConfig(format=FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Command line options
+parser = argparse.ArgumentParser(description="Zendesk <-> Basecamp sync")
+parser.add_argument('--profile', metavar='FILE',
+        help="capture a cProfile of the whole run to FILE (main thread "
+             "only, backfill workers aren't included)")
+parser.add_argument('--profile-on-signal', action='store_true',
+        help="toggle cProfile capture with SIGUSR1 (written to --profile "
+             "FILE, default zc.prof)")
+parser.add_argument('--timings', action='store_true',
+        help="log wall clock and CPU time per stage at exit")
+commands = parser.add_subparsers(dest='command')
+sync_parser = commands.add_parser('sync',
+        help="push recent tickets to Basecamp (default)")
+sync_parser.set_defaults(func=sync)
+backfill_parser = commands.add_parser('backfill',
+        help="push a group's older tickets to Basecamp")
+backfill_parser.add_argument('--since', metavar='DATE', required=True,
+        type=since_date,
+        help="import tickets created on or after DATE (YYYY-MM-DD)")
+backfill_parser.add_argument('--group', metavar='NAME', required=True,
+        help="Zendesk group to import")
+backfill_parser.add_argument('--status', default='new,open',
+        help="comma separated ticket statuses to import (default: new,open)")
+backfill_parser.add_argument('--workers', type=int, default=4,
+        help="number of parallel Basecamp workers (default: 4)")
+backfill_parser.add_argument('--budget', type=int, default=60,
+        help="maximum API requests per minute (default: 60)")
+backfill_parser.add_argument('--checkpoint', metavar='FILE',
+        help="checkpoint file (default: backfill-<group>.pkl)")
+backfill_parser.set_defaults(func=backfill)
+
+# Running without a command syncs, as before
+argv = sys.argv[1:]
+if not set(argv) & set(commands.choices):
+    argv.append('sync')
+args = parser.parse_args(argv)
 
-    # Add ticket id to processed history
-    process_log.add_processed(bc_ticket['id'])
+# Stages are always timed, but only reported with --timings
+timer = StageTimer()
+if args.timings:
+    atexit.register(timer.report)
+profiler = Profiler(args.profile or "zc.prof")
+atexit.register(profiler.stop)
+if args.profile_on_signal:
+    profiler.install_signal()
+if args.profile:
+    profiler.start()
 
-# Stage 2 - Basecamp -> Zendesk
-# Loop through Basecamp todos in Backlog and Current Sprint, find todos we
-# submitted. If they're closed, take last comment and append it to zendesk
-# ticket, notify assignee of update.
+logger.info("Starting Zendesk <-> Basecamp %s" % args.command)
+args.func(args)
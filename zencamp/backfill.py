@@ -0,0 +1,55 @@
+from os import path
+
+from zencamp.common import atomic_write
+
+import pickle
+import threading
+import time
+
+
+class RequestBudget(object):
+    """
+    Token bucket limiting API requests to rate per minute, shared by all
+    workers so a backfill can't starve the live sync of its rate limit.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens +
+                        (now - self.updated) * self.rate / 60)
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) * 60 / self.rate
+            time.sleep(wait)
+
+
+class Checkpoint(object):
+    """
+    Pickled dict of backfill progress, rewritten after every completed
+    page so an interrupted backfill resumes where it left off.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        if not path.exists(filename):
+            self.state = {}
+        else:
+            f = open(filename, 'rb')
+            self.state = pickle.load(f)
+            f.close()
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def save(self, **kwargs):
+        self.state.update(kwargs)
+        with atomic_write(self.filename) as f:
+            pickle.dump(self.state, f, True)
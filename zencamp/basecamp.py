@@ -2,7 +2,11 @@ __version__ = "0.1"
 
 from httplib import responses
 
+from zencamp.cache import ResponseCache
+from zencamp.coalesce import SingleFlight
+
 import httplib2
+import threading
 import urllib
 import base64
 import re
@@ -68,6 +72,12 @@ API_MAPPING = {
         'method': 'POST',
         'status': 201
     },
+    'delete_todo_list': {
+        # DELETE /api/v1/projects/1/todolists/1.json
+        'path': '/api/v1/projects/{{project_id}}/todolists/{{todo_list_id}}.json',
+        'method': 'DELETE',
+        'status': 204
+    },
     # Todos
     'create_todo': {
         'path': '/api/v1/projects/{{project_id}}//todolists/{{todo_list_id}}/todos.json',
@@ -85,7 +95,8 @@ API_MAPPING = {
 
 class Basecamp(object):
     def __init__(self, basecamp_id, username=None, password=None,
-            use_api_token=False, headers=None,  client_args={}):
+            use_api_token=False, headers=None,  client_args={},
+            request_budget=None):
         """
         Instantiates an instance of Basecamp. Takes optional parameters for
         HTTP Basic Authentication
@@ -101,6 +112,10 @@ class Basecamp(object):
             {'cache': False, 'timeout': 2}
             or a common one is to disable SSL certficate validation
             {"disable_ssl_certificate_validation": True}
+            or a size bounded cache enabling conditional GETs
+            {'cache': ResponseCache('.cache')}
+        request_budget - Object whose acquire() is called before every http
+            request, e.g. zencamp.backfill.RequestBudget to rate limit calls
         """
         self.data = None
 
@@ -120,10 +135,80 @@ class Basecamp(object):
                 'Content-Type': 'application/json'
             }
 
-        # Handle auth
-        self.client = httplib2.Http(**client_args)
-        if self.username and self.password:
-            self.client.add_credentials(self.username, self.password)
+        # httplib2.Http isn't thread safe, so each thread gets its own
+        # client (see the client property)
+        self.client_args = client_args
+        self._local = threading.local()
+        self.request_budget = request_budget
+
+        # In-flight GET requests, keyed by url
+        self._flight = SingleFlight()
+
+        # Todo list name -> id index, keyed by project id
+        self._todo_lists = {}
+        self._todo_lists_lock = threading.Lock()
+
+    def resolve_todo_list(self, project_id, name, description=''):
+        """
+        Return the id of the todo list called name in project_id, creating
+        it if it doesn't exist yet.
+
+        The project's todo lists are fetched once and kept in a name -> id
+        index, so repeated lookups don't hit the API. Lookups and creation
+        are serialized per instance; workers in other processes racing to
+        create the same list are reconciled by keeping the list with the
+        lowest id and deleting any duplicate we created.
+        """
+        with self._todo_lists_lock:
+            index = self._todo_lists.get(project_id)
+            if index is None:
+                index = self._index_todo_lists(project_id)
+                self._todo_lists[project_id] = index
+            if name in index:
+                return index[name]
+
+            todo_list = self.create_todo_list(project_id=project_id, data={
+                'name': name,
+                'description': description})
+            todo_list_id = todo_list['id']
+
+            # Another worker may have created the same list in the meantime
+            index.update(self._index_todo_lists(project_id))
+            winner = index.get(name, todo_list_id)
+            if winner != todo_list_id:
+                self.delete_todo_list(project_id=project_id,
+                        todo_list_id=todo_list_id)
+            index[name] = winner
+            return winner
+
+    def _index_todo_lists(self, project_id):
+        """
+        Build a name -> id index of a project's todo lists. When several
+        lists share a name the lowest (oldest) id wins.
+        """
+        index = {}
+        for todo_list in self.list_todo_lists(project_id=project_id):
+            todo_list_id = index.get(todo_list['name'])
+            if todo_list_id is None or todo_list['id'] < todo_list_id:
+                index[todo_list['name']] = todo_list['id']
+        return index
+
+    @property
+    def client(self):
+        """
+        The calling thread's http client, created on first use.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = httplib2.Http(**self.client_args)
+            # With a cache attached httplib2 would send If-Match with the
+            # cached ETag on PUT/PATCH, making updates fail with 412 once
+            # the resource changed since it was last read
+            client.optimistic_concurrency_methods = []
+            # Handle auth
+            if self.username and self.password:
+                client.add_credentials(self.username, self.password)
+        return client
 
     def __getattr__(self, api_call):
         """
@@ -159,20 +244,34 @@ class Basecamp(object):
 
             # the 'search' endpoint in an open Zendesk site doesn't return a 401
             # to force authentication. Inject the credentials in the headers to
-            # ensure we get the results we're looking for
+            # ensure we get the results we're looking for. Headers are copied
+            # per call as instances are shared between threads.
+            headers = dict(self.headers)
             if re.match("^/search\..*", path):
-                self.headers["Authorization"] = "Basic %s" % (
+                headers["Authorization"] = "Basic %s" % (
                     base64.b64encode(self.username + ':' +
                                      self.password))
-            elif "Authorization" in self.headers:
-                del(self.headers["Authorization"])
 
-            # Make an http request (data replacements are finalized)
-            response, content = self.client.request(url, method,
-                    body=json.dumps(body), headers=self.headers)
+            def request():
+                if self.request_budget:
+                    self.request_budget.acquire()
 
-            # Use a response handler to determine success/fail
-            return self._response_handler(response, content, status)
+                # Make an http request (data replacements are finalized)
+                response, content = self.client.request(url, method,
+                        body=json.dumps(body), headers=headers)
+
+                # Let a ResponseCache count responses served from cache
+                if (method == 'GET' and
+                        isinstance(self.client.cache, ResponseCache)):
+                    self.client.cache.record(response)
+
+                # Use a response handler to determine success/fail
+                return self._response_handler(response, content, status)
+
+            # Identical GETs already in flight share one request and result
+            if method == 'GET':
+                return self._flight.do(url, request)
+            return request()
 
         # Missing method is also not defined in our mapping table
         if api_call not in API_MAPPING:
@@ -189,24 +288,27 @@ class Basecamp(object):
         If the response status is different from status defined in the
         mapping table, then we assume an error and raise proper exception
 
-        Zendesk's response is sometimes the url of a newly created user/
-        ticket/group/etc and they pass this through 'location'.  Otherwise,
-        the body of 'content' has our response.
+        Basecamp returns the newly created todo list/todo/comment in the body
+        of 'content', along with its url in 'location'. Prefer the body so
+        callers don't need a second request; fall back to 'location'.
         """
         # Just in case
         if not response:
             raise BasecampException('Response Not Found')
 
-        response_status = int(response.get('status', 0))
+        # Read the attribute rather than the 'status' header: after a 304
+        # revalidation httplib2 serves the cached body with status 200 but
+        # leaves '304' in the merged headers
+        response_status = int(getattr(response, 'status', 0))
 
         if response_status != status:
             raise BasecampException(content, response_status)
 
-        # Deserialize json content if content exist. In some cases Zendesk
-        # returns ' ' strings. Also return false non strings (0, [], (), {})
-        if response.get('location'):
-            return response.get('location')
-        elif content.strip():
+        # Deserialize json content if content exist. Also return false non
+        # strings (0, [], (), {})
+        if content.strip():
             return json.loads(content)
+        elif response.get('location'):
+            return response.get('location')
         else:
             return responses[response_status]
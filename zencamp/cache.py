@@ -0,0 +1,126 @@
+from collections import OrderedDict
+
+from zencamp.common import atomic_write
+
+import httplib2
+import os
+import threading
+
+
+class ResponseCache(object):
+    """
+    On-disk HTTP response cache for httplib2, bounded by total size.
+
+    Pass it to the clients as client_args={'cache': ResponseCache(...)}.
+    httplib2 then revalidates stale GET responses with If-None-Match /
+    If-Modified-Since and serves unchanged ones from disk after a 304.
+    Entries are evicted least recently used first once the cache grows
+    past max_size bytes. Only GET responses are cached, and the clients
+    disable httplib2's If-Match on PUT/PATCH so cached ETags never turn
+    updates into 412s.
+
+    The size bound is kept per process: each instance counts the entries
+    it found on start up plus its own writes. Processes sharing the
+    directory (sync and backfill) evict each other's entries once they
+    are known, but between restarts the directory can grow past max_size
+    by what the other process wrote. Entries are written to a temporary
+    file and renamed, so a reader never sees a partial one.
+    """
+    def __init__(self, directory, max_size=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.requests = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Rebuild the LRU order from access times left by earlier runs
+        files = []
+        for name in os.listdir(directory):
+            # Skip partial writes left behind by a killed process
+            if name.endswith('.tmp'):
+                continue
+            st = os.stat(os.path.join(directory, name))
+            files.append((st.st_atime, name, st.st_size))
+        for atime, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        name = httplib2.safename(key)
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries[name] = self._entries.pop(name)
+            try:
+                f = open(self._path(name), 'rb')
+                value = f.read()
+                f.close()
+                os.utime(self._path(name), None)
+            except (IOError, OSError):
+                self.size -= self._entries.pop(name)
+                return None
+        return value
+
+    def set(self, key, value):
+        name = httplib2.safename(key)
+        with self._lock:
+            with atomic_write(self._path(name)) as f:
+                f.write(value)
+            self.size += len(value) - self._entries.pop(name, 0)
+            self._entries[name] = len(value)
+
+            while self.size > self.max_size and len(self._entries) > 1:
+                oldest, size = self._entries.popitem(last=False)
+                self._remove(oldest)
+                self.size -= size
+                self.evictions += 1
+
+    def delete(self, key):
+        name = httplib2.safename(key)
+        with self._lock:
+            if name in self._entries:
+                self.size -= self._entries.pop(name)
+                self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    def record(self, response):
+        """
+        Count a GET response. httplib2 flags both fresh and 304 revalidated
+        responses fromcache; a revalidated one keeps the 304 status in its
+        merged headers.
+        """
+        with self._lock:
+            self.requests += 1
+            if response.fromcache:
+                if response.get('status') == '304':
+                    self.revalidated += 1
+                else:
+                    self.hits += 1
+
+    def stats(self):
+        served = self.hits + self.revalidated
+        return {
+            'requests': self.requests,
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.requests - served,
+            'hit_rate': self.requests and float(served) / self.requests,
+            'entries': len(self._entries),
+            'size': self.size,
+            'evictions': self.evictions,
+        }
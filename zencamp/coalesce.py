@@ -0,0 +1,105 @@
+import sys
+import threading
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Collapse concurrent calls for the same key into one.
+
+    The first caller for a key runs the function; anyone asking for the
+    same key while it is in flight waits and receives the same result (or
+    exception). The result object is shared between callers, so treat it
+    as read only.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = fn()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class _Batch(object):
+    def __init__(self):
+        self.ids = []
+        self.full = threading.Event()
+        self.event = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Merge per-id lookups made within a short window into one bulk call.
+
+    fetch_many is called with a list of ids and must return a dict of
+    id -> result; ids missing from the dict resolve to None. A batch is
+    sent when the window expires or max_size ids have been collected.
+    """
+    def __init__(self, fetch_many, window=0.01, max_size=100):
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def get(self, object_id):
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            if object_id not in batch.ids:
+                batch.ids.append(object_id)
+            if len(batch.ids) >= self.max_size:
+                # Full, later lookups start a new batch and the leader
+                # sends this one right away
+                self._pending = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            try:
+                batch.results = self.fetch_many(batch.ids)
+            except:
+                batch.error = sys.exc_info()
+                raise
+            finally:
+                batch.event.set()
+        else:
+            batch.event.wait()
+            if batch.error:
+                raise batch.error[0], batch.error[1], batch.error[2]
+
+        return batch.results.get(object_id)
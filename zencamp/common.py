@@ -1,8 +1,31 @@
 import ConfigParser
+import os
 import sys
+import thread
+from contextlib import contextmanager
 from os import path
 
 
+@contextmanager
+def atomic_write(filename, mode='wb'):
+    """
+    Open a temporary file for writing and rename it over filename once the
+    block completes, so readers (and a crash) never see a partial file.
+    The temporary name is unique per process and thread.
+    """
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), thread.get_ident())
+    f = open(tmp, mode)
+    try:
+        yield f
+        f.close()
+        os.rename(tmp, filename)
+    except:
+        f.close()
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 class AttributeInitType(type):
     def __call__(self, *args, **kwargs):
         obj = type.__call__(self, *args)
@@ -26,6 +49,12 @@ class ZendeskConfig(object):
     _config_name = "zendesk"
 
 
+class CacheConfig(object):
+    __metaclass__ = AttributeInitType
+    __slots__ = ['directory', 'max_size']
+    _config_name = "cache"
+
+
 class Config(object):
     def __init__(self):
         """
@@ -51,3 +80,11 @@ class Config(object):
 
     def zendesk(self):
         return self._config_factory(ZendeskConfig)
+
+    def cache(self):
+        """
+        The [cache] section is optional, returns None when it's missing
+        """
+        if not self.config.has_section(CacheConfig._config_name):
+            return None
+        return self._config_factory(CacheConfig)
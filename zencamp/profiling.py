@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cProfile
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_time():
+    """
+    User + system CPU seconds used by this process.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class StageTimer(object):
+    """
+    Records wall clock and CPU time for named stages of a run. Stages
+    entered more than once (e.g. per page) are summed. CPU time is for the
+    whole process, so it includes worker threads. Stages may be entered
+    from any thread.
+    """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            with self._lock:
+                totals = self.stages.setdefault(name, [0.0, 0.0, 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+
+    def report(self):
+        for name, (wall, cpu, count) in self.stages.items():
+            logger.info("Stage %-20s wall %8.3fs  cpu %8.3fs  (x%d)" % (
+                name, wall, cpu, count))
+
+
+class Profiler(object):
+    """
+    Opt-in cProfile capture written to filename.
+
+    start()/stop() bracket a capture; stop() writes the stats file, which
+    can be read with pstats or snakeviz. install_signal() lets a running
+    process toggle capture on and off, e.g. `kill -USR1 <pid>`.
+
+    cProfile only sees the thread that started it, so work done in worker
+    threads (backfill's pool) doesn't show up; use StageTimer for those.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.profile = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.running:
+            return
+        logger.info("Starting profiler, writing to %s" % self.filename)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+        self.profile = None
+        logger.info("Profile written to %s" % self.filename)
+
+    def toggle(self, *args):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.toggle)
+        # Don't let the signal interrupt in-flight HTTP requests
+        signal.siginterrupt(signum, False)
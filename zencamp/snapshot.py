@@ -0,0 +1,186 @@
+from array import array
+from calendar import timegm
+from itertools import izip
+from os import path
+
+from zencamp.common import atomic_write
+
+import logging
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+
+STATUSES = ('new', 'open', 'pending', 'hold', 'solved', 'closed')
+PRIORITIES = (None, 'low', 'normal', 'high', 'urgent')
+UNSOLVED = ('new', 'open', 'pending', 'hold')
+
+# Values outside STATUSES/PRIORITIES (e.g. 'deleted' for soft-deleted
+# tickets) are stored as UNKNOWN rather than rejected
+UNKNOWN = -1
+STATUS_CODES = dict((s, i) for i, s in enumerate(STATUSES))
+PRIORITY_CODES = dict((p, i) for i, p in enumerate(PRIORITIES))
+
+
+def parse_timestamp(value):
+    """
+    Convert a Zendesk timestamp (2012-04-04T09:14:57Z) to epoch seconds.
+    Missing values are stored as 0.
+    """
+    if not value:
+        return 0
+    # Fixed width, so slicing is much cheaper than strptime on bulk updates
+    return timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                   int(value[11:13]), int(value[14:16]), int(value[17:19])))
+
+
+class TicketSnapshot(object):
+    """
+    Compact, column oriented copy of the ticket fields we report on.
+
+    Each field is kept in its own typed array and tickets are located by id
+    through a row index, so a million tickets take a few tens of megabytes
+    and aggregates are a single pass over the relevant columns without any
+    API traffic. The snapshot is updated incrementally with update() and
+    persisted with save(). cursor is saved alongside the columns; the sync
+    stores the incremental export's end_time there so the snapshot and
+    its position in the export never disagree.
+    """
+    _header = struct.Struct('<4sIq')
+    _magic = 'ZCS2'
+    _columns = (
+        ('ids', 'l'),
+        ('status', 'b'),
+        ('priority', 'b'),
+        ('group_id', 'l'),
+        ('created_at', 'l'),
+        ('updated_at', 'l'),
+    )
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        for name, typecode in self._columns:
+            setattr(self, name, array(typecode))
+        self._rows = {}
+        self.cursor = 0
+
+        if filename and path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, filename):
+        f = open(filename, 'rb')
+        try:
+            magic, count, cursor = self._header.unpack(
+                f.read(self._header.size))
+            if magic == 'ZCS1':
+                # No cursor in the first format, rebuild from the export
+                logger.warning("Ticket snapshot %s has an old format, "
+                               "starting with an empty snapshot." % filename)
+                return
+            if magic != self._magic:
+                raise ValueError("%s is not a ticket snapshot" % filename)
+            columns = []
+            for name, typecode in self._columns:
+                column = array(typecode)
+                column.fromfile(f, count)
+                columns.append((name, column))
+        except (struct.error, EOFError):
+            # Truncated file, start over rather than failing every run
+            logger.warning("Ticket snapshot %s is truncated, starting with "
+                           "an empty snapshot." % filename)
+            return
+        finally:
+            f.close()
+
+        for name, column in columns:
+            setattr(self, name, column)
+        self._rows = dict(izip(self.ids, xrange(count)))
+        self.cursor = cursor
+
+    def save(self, filename=None):
+        filename = filename or self.filename
+        with atomic_write(filename) as f:
+            f.write(self._header.pack(self._magic, len(self.ids),
+                                      self.cursor))
+            for name, typecode in self._columns:
+                getattr(self, name).tofile(f)
+
+    def update(self, tickets):
+        """
+        Insert or refresh tickets (as returned by the Zendesk API).
+        Returns the number of tickets written.
+        """
+        count = 0
+        for ticket in tickets:
+            values = (
+                ticket['id'],
+                STATUS_CODES.get(ticket.get('status'), UNKNOWN),
+                PRIORITY_CODES.get(ticket.get('priority'), UNKNOWN),
+                ticket.get('group_id') or 0,
+                parse_timestamp(ticket.get('created_at')),
+                parse_timestamp(ticket.get('updated_at')),
+            )
+            row = self._rows.get(ticket['id'])
+            if row is None:
+                self._rows[ticket['id']] = len(self.ids)
+                for (name, typecode), value in izip(self._columns, values):
+                    getattr(self, name).append(value)
+            else:
+                for (name, typecode), value in izip(self._columns, values):
+                    getattr(self, name)[row] = value
+            count += 1
+        return count
+
+    def _status_codes(self, statuses):
+        return frozenset(STATUS_CODES[s] for s in statuses
+                         if s in STATUS_CODES)
+
+    def count_by_group(self, statuses=UNSOLVED):
+        """
+        Return {group_id: ticket count} for tickets in the given statuses.
+        Tickets without a group are counted under None.
+        """
+        codes = self._status_codes(statuses)
+        counts = {}
+        for status, group_id in izip(self.status, self.group_id):
+            if status in codes:
+                counts[group_id] = counts.get(group_id, 0) + 1
+        if 0 in counts:
+            counts[None] = counts.pop(0)
+        return counts
+
+    def age_histogram(self, bins, statuses=UNSOLVED, now=None):
+        """
+        Bucket ticket ages (in seconds since creation) by the ascending
+        upper bounds in bins. The returned list has one extra bucket for
+        tickets older than the last bound.
+        """
+        now = int(now or time.time())
+        codes = self._status_codes(statuses)
+        bins = sorted(bins)
+        counts = [0] * (len(bins) + 1)
+        for status, created_at in izip(self.status, self.created_at):
+            if status in codes:
+                age = now - created_at
+                for i, bound in enumerate(bins):
+                    if age <= bound:
+                        counts[i] += 1
+                        break
+                else:
+                    counts[-1] += 1
+        return counts
+
+    def sla_breaches(self, max_age, statuses=UNSOLVED, now=None):
+        """
+        Return the ids of tickets in the given statuses that were created
+        more than max_age seconds ago.
+        """
+        cutoff = int(now or time.time()) - max_age
+        codes = self._status_codes(statuses)
+        return [ticket_id for ticket_id, status, created_at in
+                izip(self.ids, self.status, self.created_at)
+                if status in codes and created_at < cutoff]
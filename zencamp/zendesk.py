@@ -2,7 +2,12 @@ __version__ = "0.1"
 
 from httplib import responses
 
+from zencamp.cache import ResponseCache
+from zencamp.coalesce import MicroBatcher, SingleFlight
+
 import httplib2
+import threading
+import time
 import urllib
 import base64
 import re
@@ -50,7 +55,8 @@ API_MAPPING = {
         'status': 200,
     },
     'show_organization': {
-        'path': '/organizations/{{organization_id}}.json',
+        # v2, so the payload matches the show_many_organizations batch
+        'path': '/api/v2/organizations/{{organization_id}}.json',
         'method': 'GET',
         'status': 200,
     },
@@ -64,6 +70,12 @@ API_MAPPING = {
         'method': 'PUT',
         'status': 200,
     },
+    'show_many_organizations': {
+        'path': '/api/v2/organizations/show_many.json',
+        'valid_params': ('ids', ),
+        'method': 'GET',
+        'status': 200,
+    },
     'delete_organization': {
         'path': '/organizations/{{organization_id}}.json',
         'method': 'DELETE',
@@ -108,6 +120,12 @@ API_MAPPING = {
         'method': 'GET',
         'status': 200,
     },
+    'incremental_tickets': {
+        'path': '/api/v2/incremental/tickets.json',
+        'valid_params': ('start_time', ),
+        'method': 'GET',
+        'status': 200,
+    },
     'show_ticket': {
         'path': '/tickets/{{ticket_id}}.json',
         'method': 'GET',
@@ -154,7 +172,14 @@ API_MAPPING = {
         'status': 200,
     },
     'show_user': {
-        'path': '/users/{{user_id}}.json',
+        # v2, so the payload matches the show_many_users batch
+        'path': '/api/v2/users/{{user_id}}.json',
+        'method': 'GET',
+        'status': 200,
+    },
+    'show_many_users': {
+        'path': '/api/v2/users/show_many.json',
+        'valid_params': ('ids', ),
         'method': 'GET',
         'status': 200,
     },
@@ -238,9 +263,33 @@ API_MAPPING = {
 }
 
 
+# Times a request rejected with 429 Too Many Requests is retried
+RATE_LIMIT_RETRIES = 3
+
+
+# Single object lookups that can be merged into a bulk call when batching is
+# enabled. 'param' is the lookup's id keyword, 'key' the list in the bulk
+# response and 'item' the key the single lookup returns its object under.
+BULK_MAPPING = {
+    'show_user': {
+        'call': 'show_many_users',
+        'param': 'user_id',
+        'key': 'users',
+        'item': 'user',
+    },
+    'show_organization': {
+        'call': 'show_many_organizations',
+        'param': 'organization_id',
+        'key': 'organizations',
+        'item': 'organization',
+    },
+}
+
+
 class Zendesk(object):
     def __init__(self, subdomain, username=None, password=None,
-            use_api_token=False, headers=None,  client_args={}):
+            use_api_token=False, headers=None,  client_args={},
+            batch_window=None, request_budget=None):
         """
         Instantiates an instance of Zendesk. Takes optional parameters for
         HTTP Basic Authentication
@@ -257,6 +306,13 @@ class Zendesk(object):
             {'cache': False, 'timeout': 2}
             or a common one is to disable SSL certficate validation
             {"disable_ssl_certificate_validation": True}
+            or a size bounded cache enabling conditional GETs
+            {'cache': ResponseCache('.cache')}
+        batch_window - Seconds to collect concurrent show_user/
+            show_organization lookups before sending them as one bulk
+            request. Disabled by default.
+        request_budget - Object whose acquire() is called before every http
+            request, e.g. zencamp.backfill.RequestBudget to rate limit calls
         """
         self.data = None
 
@@ -275,10 +331,60 @@ class Zendesk(object):
                 'Content-Type': 'application/json'
             }
 
-        # Handle auth
-        self.client = httplib2.Http(**client_args)
-        if self.username and self.password:
-            self.client.add_credentials(self.username, self.password)
+        # httplib2.Http isn't thread safe, so each thread gets its own
+        # client (see the client property)
+        self.client_args = client_args
+        self._local = threading.local()
+        self.request_budget = request_budget
+
+        # In-flight GET requests, keyed by url
+        self._flight = SingleFlight()
+
+        # Bulk lookup batchers, keyed by api call
+        self.batch_window = batch_window
+        self._batchers = {}
+        self._batchers_lock = threading.Lock()
+
+    def _batched(self, api_call, object_id):
+        """
+        Look up a single object through the batcher for api_call. The v2
+        bulk and single endpoints return the same objects, so wrapping it
+        under 'item' gives exactly what the single lookup returns.
+        """
+        bulk = BULK_MAPPING[api_call]
+
+        def fetch_many(ids):
+            result = getattr(self, bulk['call'])(
+                ids=','.join(str(i) for i in ids))
+            return dict((item['id'], item) for item in result[bulk['key']])
+
+        with self._batchers_lock:
+            batcher = self._batchers.get(api_call)
+            if batcher is None:
+                batcher = self._batchers[api_call] = MicroBatcher(
+                    fetch_many, self.batch_window)
+
+        item = batcher.get(int(object_id))
+        if item is None:
+            raise ZendeskException('Not Found', 404)
+        return {bulk['item']: item}
+
+    @property
+    def client(self):
+        """
+        The calling thread's http client, created on first use.
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = httplib2.Http(**self.client_args)
+            # With a cache attached httplib2 would send If-Match with the
+            # cached ETag on PUT/PATCH, making updates fail with 412 once
+            # the resource changed since it was last read
+            client.optimistic_concurrency_methods = []
+            # Handle auth
+            if self.username and self.password:
+                client.add_credentials(self.username, self.password)
+        return client
 
     def __getattr__(self, api_call):
         """
@@ -289,6 +395,11 @@ class Zendesk(object):
         in the method will populate missing data.
         """
         def call(self, **kwargs):
+            bulk = BULK_MAPPING.get(api_call)
+            if (self.batch_window and bulk and
+                    kwargs.keys() == [bulk['param']]):
+                return self._batched(api_call, kwargs[bulk['param']])
+
             api_map = API_MAPPING[api_call]
             method = api_map['method']
             path = api_map['path']
@@ -314,20 +425,43 @@ class Zendesk(object):
 
             # the 'search' endpoint in an open Zendesk site doesn't return a 401
             # to force authentication. Inject the credentials in the headers to
-            # ensure we get the results we're looking for
+            # ensure we get the results we're looking for. Headers are copied
+            # per call as instances are shared between threads.
+            headers = dict(self.headers)
             if re.match("^/search\..*", path):
-                self.headers["Authorization"] = "Basic %s" % (
+                headers["Authorization"] = "Basic %s" % (
                     base64.b64encode(self.username + ':' +
                                      self.password))
-            elif "Authorization" in self.headers:
-                del(self.headers["Authorization"])
 
-            # Make an http request (data replacements are finalized)
-            response, content = self.client.request(url, method,
-                    body=json.dumps(body), headers=self.headers)
+            def request():
+                for attempt in range(RATE_LIMIT_RETRIES + 1):
+                    if self.request_budget:
+                        self.request_budget.acquire()
+
+                    # Make an http request (data replacements are finalized)
+                    response, content = self.client.request(url, method,
+                            body=json.dumps(body), headers=headers)
+
+                    # Zendesk answers 429 with a Retry-After (in seconds)
+                    # once a rate limit, e.g. the incremental export's 10
+                    # requests per minute, is exceeded
+                    if (response.status != 429 or
+                            attempt == RATE_LIMIT_RETRIES):
+                        break
+                    time.sleep(int(response.get('retry-after', 60)))
+
+                # Let a ResponseCache count responses served from cache
+                if (method == 'GET' and
+                        isinstance(self.client.cache, ResponseCache)):
+                    self.client.cache.record(response)
+
+                # Use a response handler to determine success/fail
+                return self._response_handler(response, content, status)
 
-            # Use a response handler to determine success/fail
-            return self._response_handler(response, content, status)
+            # Identical GETs already in flight share one request and result
+            if method == 'GET':
+                return self._flight.do(url, request)
+            return request()
 
         # Missing method is also not defined in our mapping table
         if api_call not in API_MAPPING:
@@ -352,7 +486,10 @@ class Zendesk(object):
         if not response:
             raise ZendeskException('Response Not Found')
 
-        response_status = int(response.get('status', 0))
+        # Read the attribute rather than the 'status' header: after a 304
+        # revalidation httplib2 serves the cached body with status 200 but
+        # leaves '304' in the merged headers
+        response_status = int(getattr(response, 'status', 0))
 
         if response_status != status:
             raise ZendeskException(content, response_status)